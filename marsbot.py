@@ -1,10 +1,11 @@
+import asyncio
 import atexit
-import codecs
-import io
 import json
 import logging
+import os
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Optional
 
 import cv2
@@ -23,6 +24,9 @@ from config import admins, BOT_NAME, API_ID, API_HASH, BOT_SESSION_NAME, BOT_TOK
 logging.basicConfig(format='[%(levelname) 5s/%(asctime)s] %(name)s: %(message)s',
                     level=logging.WARNING)
 
+# OpenCV 在 imdecode/resize 时会释放 GIL，放到线程池里算 dhash 不会卡住事件循环
+_CV_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+
 
 def init_bot():
     bot_ = telethon.TelegramClient(
@@ -54,6 +58,9 @@ class MarsInfo:
     def has_uid(self, uid):
         return uid in self.unique_id_to_dhash.keys()
 
+    def get_uid_dhash(self, uid) -> Optional[str]:
+        return self.unique_id_to_dhash.get(uid, None)
+
     def uid_count(self, uid):
         dhash = self.unique_id_to_dhash[uid]
         return self.dhash_count(dhash)
@@ -133,9 +140,12 @@ class MarsInfo:
 
     @classmethod
     def save(cls, filename="mars.json"):
+        # json.dump 和带 indent 的 dumps 都走纯 Python 编码器，逐个片段写文件；
+        # 不带 indent 一次性 dumps 才会用 C 编码器
+        data = json.dumps(cls._use_mars_bot_groups, default=lambda obj: obj.to_dict(), ensure_ascii=False,
+                          sort_keys=True)
         with open(filename, "w", encoding="utf-8")as f:
-            json.dump(cls._use_mars_bot_groups, f, default=lambda obj: obj.to_dict(), ensure_ascii=False,
-                      sort_keys=True, indent=1)
+            f.write(data)
 
     @classmethod
     def load(cls, filename="mars.json"):
@@ -183,33 +193,55 @@ def get_from_user(event: NewMessage.Event) -> int:
 
 
 def check_image(event: NewMessage.Event) -> bool:
+    # 每条消息都会经过这里，先做最便宜的图片判断
+    if not isinstance(event.message.media, MessageMediaPhoto):
+        return False
     chat_id = get_bot_chat_id(event.message.peer_id)
     mars_info = MarsInfo.get_chat_ins(chat_id)
+    if mars_info is None:
+        return False
     user_id = get_from_user(event)
-    if mars_info is not None and not mars_info.user_in_white_list(user_id):
-        return isinstance(event.message.media, MessageMediaPhoto)
+    return not mars_info.user_in_white_list(user_id)
 
 
 def dhash_bytes(data):
     data = np.frombuffer(data, np.uint8)
+    # 存下来的 dhash 只做精确匹配，且不保存原图无法重算，解码方式一改旧记录就全部失配，
+    # 所以这里必须保持和以前完全一致的像素：彩色图依旧 BGR 解码后 cvtColor
     img = cv2.imdecode(data, cv2.IMREAD_ANYCOLOR)
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if img.ndim == 3:
+        # 灰度 JPEG 会被解成单通道，直接 cvtColor(BGR2GRAY) 会报错
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     img = cv2.resize(img, (9, 8), interpolation=cv2.INTER_AREA)
-    dhash_bits = np.greater(img[:, :8], img[:, 1:]).flatten()
-    dhash = np.packbits(dhash_bits).tobytes()
-    return codecs.encode(dhash, "hex").decode("ascii")
+    # packbits 不指定 axis 时会自己展平，省掉 flatten 的拷贝
+    return np.packbits(img[:, :8] > img[:, 1:]).tobytes().hex()
+
+
+# 跨群共享的 uid -> dhash 缓存，同一张图被转发到别的群时不用重新下载计算
+_UID_DHASH_CACHE_SIZE = 50000
+_uid_dhash_cache: Dict[str, str] = dict()
+
+
+def cache_uid_dhash(uid, dhash):
+    if len(_uid_dhash_cache) >= _UID_DHASH_CACHE_SIZE:
+        # dict 保持插入顺序，删掉最早的那个即可
+        _uid_dhash_cache.pop(next(iter(_uid_dhash_cache)))
+    _uid_dhash_cache[uid] = dhash
+
+
+T_ME_LINK_FMT = "https://t.me/c/{}/{}"
+MSG_TEXT_FMT = '你这张图片已经<a href="{0}">火星{1}次</a>了！'
+MARS_X_TIMES_FMT = '你已经让这张图片<a href="{0}">第{1}次火星</a>了，现在本车送你 ”火星之王“ 称号！'
+MARS_GRATER_X_TIMES_FMT = '火星之王，收了你的神通吧，这图都已经<a href="{0}">火星{1}次</a>了！'
 
 
 def generate_mars_text(link, count, threshold):
-    msg_text_fmt = '你这张图片已经<a href="{0}">火星{1}次</a>了！'
-    mars_x_times_fmt = '你已经让这张图片<a href="{0}">第{1}次火星</a>了，现在本车送你 ”火星之王“ 称号！'
-    mars_grater_x_times_fmt = '火星之王，收了你的神通吧，这图都已经<a href="{0}">火星{1}次</a>了！'
     if count > threshold:
-        return mars_grater_x_times_fmt.format(link, count)
+        return MARS_GRATER_X_TIMES_FMT.format(link, count)
     elif count == threshold:
-        return mars_x_times_fmt.format(link, count)
+        return MARS_X_TIMES_FMT.format(link, count)
     else:
-        return msg_text_fmt.format(link, count)
+        return MSG_TEXT_FMT.format(link, count)
 
 
 @bot.on(NewMessage(func=check_image))
@@ -219,26 +251,26 @@ async def check_photo_mars(event: NewMessage.Event):
     photo_uid = "uid" + str((photo.id * 10) + photo.dc_id)  # 该语句为唯一确定uid的方法
     mars_info = MarsInfo.get_chat_ins(chat_id)
     msg_id = event.message.id
-    t_me_link_fmt = "https://t.me/c/{}/{}"
 
-    if mars_info.has_uid(photo_uid):
-        count = mars_info.uid_count(photo_uid)
-        mars_info.uid_count_plus(photo_uid)
-        last_msg_id = mars_info.get_uid_last_msg(photo_uid)
-        link = t_me_link_fmt.format(get_raw_chat_id(event.message.peer_id), last_msg_id)
+    dhash = mars_info.get_uid_dhash(photo_uid)  # 只查一次 uid，后面都直接用 dhash
+    if dhash is not None:
+        count = mars_info.dhash_count(dhash)
+        mars_info.dhash_count_plus(dhash)
+        last_msg_id = mars_info.get_dhash_last_msg(dhash)
+        link = T_ME_LINK_FMT.format(get_raw_chat_id(event.message.peer_id), last_msg_id)
         msg_text = generate_mars_text(link, count, 10)
-        mars_info.set_uid_last_msg(photo_uid, msg_id)
+        mars_info.set_dhash_last_msg(dhash, msg_id)
     else:
-        buffer = io.BytesIO()
-        await bot.download_media(event.message, buffer, thumb=-1)
-        buffer.seek(0)
-        data = buffer.read()
-        dhash = dhash_bytes(data)
+        dhash = _uid_dhash_cache.get(photo_uid, None)
+        if dhash is None:
+            data = await bot.download_media(event.message, bytes, thumb=-1)
+            dhash = await asyncio.get_running_loop().run_in_executor(_CV_POOL, dhash_bytes, data)
+            cache_uid_dhash(photo_uid, dhash)
         count = mars_info.dhash_count(dhash)
         mars_info.add_uid_and_dhash(photo_uid, dhash)
         if count > 0:
             last_msg_id = mars_info.get_dhash_last_msg(dhash)
-            link = t_me_link_fmt.format(get_raw_chat_id(event.message.peer_id), last_msg_id)
+            link = T_ME_LINK_FMT.format(get_raw_chat_id(event.message.peer_id), last_msg_id)
             msg_text = generate_mars_text(link, count, 10)
             mars_info.set_dhash_last_msg(dhash, msg_id)
         else: